@@ -8,71 +8,351 @@ directory is valid, then the backup file will be created on the first run.
 
 >> python3 sqlite3backup.py  ~/myproject/src.db ~/myproject/backup.db
 
-A backup.log file is created in the directory where the script is launched.
+To keep a log, set the SQLITE3BACKUP_LOG environment variable to the path of the log file.
+
+>> SQLITE3BACKUP_LOG=backup.log python3 sqlite3backup.py  ~/myproject/src.db ~/myproject/backup.db
 """
 import os
 import sys
-import argparse
 import pathlib
-import platform
-import logging
 import sqlite3
+import warnings
+from contextlib import closing
 
 # sqlite3 doesn't work on versions less than 3.7.
-MIN_VERSION = 3.7
+MIN_VERSION = (3, 7)
+
+# Interpreter version cannot change while the process runs; check it once.
+_VERSION_OK = sys.version_info >= MIN_VERSION
+
+# Journal modes make no sense for databases that only live in memory.
+IN_MEMORY_DB = ':memory:'
+
+# Source databases at least this big (bytes) are copied file-to-file when nobody is writing.
+FAST_COPY_THRESHOLD = 64 * 1024 * 1024
+
+# Bytes of the source database read through a memory map rather than read() calls.
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Database header holds change counters that differ between a database and its backup.
+HEADER_SIZE = 100
 
 
 # Private API
-def _version_ok(min_version : float = MIN_VERSION) -> bool:
+def _version_ok() -> bool:
     """Sqlite3.backup only exists in Python versions 3.7 or greater."""
-    major, minor, _ = platform.python_version_tuple()
-    curr_version =  int(major) + int(minor) / 10 
-    return curr_version >= min_version
+    return _VERSION_OK
 
 
 def _parse_args() -> (pathlib.Path, pathlib.Path):
-    parser = argparse.ArgumentParser(description='Backup sqlite3 database.')
-    parser.add_argument('src_path', type=pathlib.Path)
-    parser.add_argument('dest_path', type=pathlib.Path)
-    args = parser.parse_args()
-    return  args.src_path, args.dest_path
+    # Two positional arguments only; not worth argparse's import time.
+    if len(sys.argv) != 3:
+        sys.exit("Usage: sqlite3backup.py SRC DEST")
+    return pathlib.Path(sys.argv[1]), pathlib.Path(sys.argv[2])
+
+
+def _source_uri(srcdb : pathlib.Path, mode : str) -> str:
+    # Unlike a plain path, mode=ro/rw never creates a missing source database.
+    return f"{pathlib.Path(srcdb).resolve().as_uri()}?mode={mode}"
+
+
+def _connect_readonly(srcdb : pathlib.Path, timeout : float) -> sqlite3.Connection:
+    # Read-only connection never escalates to a write lock, so it cannot contend with writers.
+    if str(srcdb) == IN_MEMORY_DB:
+        return sqlite3.connect(srcdb, timeout=timeout)
+    con = sqlite3.connect(_source_uri(srcdb, "ro"), timeout=timeout, uri=True)
+    con.execute("PRAGMA query_only=1")
+    con.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return con
+
+
+def _enable_wal(srcdb : pathlib.Path, timeout : float):
+    # Switching journal mode writes to the database header; not possible on a read-only connection.
+    with closing(sqlite3.connect(_source_uri(srcdb, "rw"), timeout=timeout, uri=True)) as con:
+        con.execute("PRAGMA journal_mode=WAL")
+
+
+def _checkpoint_wal(srcdb : pathlib.Path, timeout : float = 0) -> bool:
+    # Move WAL frames into the main file so the backup reads pages from one file only. Needs 
+    # write access, so best effort: the backup is consistent either way. No busy timeout by 
+    # default, so clients reading the source never stall the backup; whatever they pin stays 
+    # in the WAL. Returns whether the WAL was emptied.
+    try:
+        with closing(sqlite3.connect(_source_uri(srcdb, "rw"), timeout=timeout, uri=True)) as con:
+            busy, _, _ = con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return not busy
 
 
-def _check_files(srcdb : pathlib.Path, backupdb : pathlib.Path) -> bool:
-    # Check file to be backed up.
-    if not srcdb.exists() or not srcdb.is_file():
+def _check_source(srcdb : pathlib.Path):
+    # SQLite only says "unable to open database file"; find out why once it has failed.
+    srcdb = pathlib.Path(srcdb)
+    if not srcdb.is_file():
         raise FileNotFoundError(f"Source database file does not exist or is not a file:\n{str(srcdb)}")
     if not os.access(srcdb, os.R_OK):
         raise PermissionError(f"Read access to file denied:\n{str(srcdb)}")
-    # Check backup copy.
+
+
+def _check_backup(backupdb : pathlib.Path):
+    # Same as _check_source, for the backup file. A missing parent directory stays an SQLite error.
+    backupdb = pathlib.Path(backupdb)
     if backupdb.exists():
         if not os.access(backupdb, os.W_OK):
             raise PermissionError(f"Write access to file denied:\n{str(backupdb)}")
-        else:
-            if not os.access(backupdb.parent, os.W_OK):
-                err = f"Write access to parent directory denied:\n{str(backupdb.parent)}"
-                raise PermissionError(err)
+    elif backupdb.parent.exists() and not os.access(backupdb.parent, os.W_OK | os.X_OK):
+        err = f"Write access to parent directory denied:\n{str(backupdb.parent)}"
+        raise PermissionError(err)
+
+
+def _copy_range(src_fd : int, dst_fd : int, size : int):
+    # Kernel-side copy where available; plain positional reads and writes otherwise.
+    offset = 0
+    while offset < size:
+        count = min(size - offset, 1024 * 1024 * 1024)
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except (AttributeError, OSError):
+            copied = os.pwrite(dst_fd, os.pread(src_fd, count, offset), offset)
+        if not copied:
+            raise OSError(f"Source database file shrank during copy at byte {offset}")
+        offset += copied
+    os.ftruncate(dst_fd, size)
+
+
+def _fast_copy(con : sqlite3.Connection, srcdb : pathlib.Path, backupdb : pathlib.Path,
+               timeout : float, safe : bool) -> bool:
+    # Large rollback-journal databases are copied by the kernel (copy_file_range) instead of 
+    # page by page. WAL databases keep committed pages outside the main file.
+    if str(srcdb) == IN_MEMORY_DB or os.stat(srcdb).st_size < FAST_COPY_THRESHOLD:
+        return False
+    if con.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        return False
+    with closing(sqlite3.connect(backupdb, timeout=timeout)) as bck:
+        # Readers of a WAL backup file do not take locks that would keep them off the copy.
+        if bck.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            return False
+        # Closing any descriptor of a file drops all POSIX locks this process holds on it, so 
+        # both files stay open until the SQLite locks below have been released.
+        src_fd = os.open(srcdb, os.O_RDONLY)
+        try:
+            dst_fd = os.open(backupdb, os.O_WRONLY)
+            try:
+                # Exclusive lock on the backup keeps other clients out (waiting up to the busy 
+                # timeout) and rolls back any hot journal before the copy; the shared lock held 
+                # by an open read transaction on the source stops writers from committing.
+                bck.execute("BEGIN EXCLUSIVE")
+                try:
+                    con.execute("BEGIN")
+                    try:
+                        con.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                        _copy_range(src_fd, dst_fd, os.fstat(src_fd).st_size)
+                        if safe:
+                            os.fsync(dst_fd)
+                    finally:
+                        con.rollback()
+                finally:
+                    bck.rollback()
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
     return True
 
-    
+
+def _tune_destination(con : sqlite3.Connection, safe : bool):
+    # Backup file is only written to while the backup runs; trade durability for throughput.
+    if safe:
+        # Journal stays on disk so a crash cannot corrupt an existing backup.
+        con.execute("PRAGMA synchronous=NORMAL")
+    else:
+        con.execute("PRAGMA synchronous=OFF")
+        # Backup of a WAL source is in WAL mode too. Leaving WAL needs exclusive access, which 
+        # any other client that has the backup open would block, so leave it be.
+        if con.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA cache_size=-200000")
+    con.execute("PRAGMA temp_store=MEMORY")
+
+
+def _preallocate(con : sqlite3.Connection, backupdb : pathlib.Path, size : int):
+    # Reserve the whole file in one extent instead of growing it page by page. SQLite rejects 
+    # a zero-filled file, so have it write the header page first; the backup truncates the rest.
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    con.execute("PRAGMA user_version=0")
+    fd = os.open(backupdb, os.O_WRONLY)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass  # Filesystem does not support it; file simply grows as it is written.
+    finally:
+        os.close(fd)
+
+
+def _file_digest(f) -> bytes:
+    import hashlib
+    f.seek(HEADER_SIZE)
+    # OpenSSL picks SHA-NI / ARMv8 SHA2 instructions where the CPU has them.
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, 'sha256').digest()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def _verify(con : sqlite3.Connection, bck : sqlite3.Connection, srcdb : pathlib.Path, 
+            backupdb : pathlib.Path, timeout : float):
+    # Only the main files are hashed, so every committed page has to be in them. A WAL backup 
+    # got its pages written to its -wal file; a WAL source may still have frames in its own.
+    unverifiable = f"Backup could not be verified, WAL checkpoint blocked:\n{str(backupdb)}"
+    if bck.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        if bck.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]:
+            raise sqlite3.DatabaseError(unverifiable)
+    if con.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        if not _checkpoint_wal(srcdb, timeout):
+            raise sqlite3.DatabaseError(unverifiable)
+    # Files stay open until the read transaction ends; closing them early would drop its lock.
+    with open(srcdb, 'rb') as src_file, open(backupdb, 'rb') as bck_file:
+        # Shared lock held by an open read transaction stops writers from committing mid-hash.
+        con.execute("BEGIN")
+        try:
+            con.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            if _file_digest(src_file) != _file_digest(bck_file):
+                raise sqlite3.DatabaseError(f"Backup does not match source database:\n{str(backupdb)}")
+        finally:
+            con.rollback()
+
+
+def _set_page_size(con : sqlite3.Connection, page_size : int):
+    # Page size cannot be changed in WAL mode, so toggle it off for the duration of the vacuum. 
+    # Leaving WAL needs exclusive access, which any other client that has the backup open would 
+    # block; the backup itself is complete by now, so only warn about it.
+    mode = con.execute("PRAGMA journal_mode").fetchone()[0]
+    try:
+        if mode == "wal":
+            con.execute("PRAGMA journal_mode=DELETE")
+        con.execute(f"PRAGMA page_size={int(page_size)}")
+        con.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        warnings.warn(f"Backup complete, but its page size could not be changed: {e}", 
+                      RuntimeWarning)
+    finally:
+        if mode == "wal":
+            con.execute("PRAGMA journal_mode=WAL")
+
+
 # Public API
-def backup_database(srcdb : pathlib.Path, backupdb : pathlib.Path):
+class BackupError(Exception):
+    """Raised by backup_many when one or more backups fail.
+
+    Attributes:
+        failures: List of ((srcdb, backupdb), exception) tuples, one per failed backup.
+    """
+    def __init__(self, failures : list):
+        self.failures = failures
+        details = "\n".join(f"{str(srcdb)} -> {str(backupdb)}: {type(e).__name__}: {e}"
+                            for (srcdb, backupdb), e in failures)
+        super().__init__(f"{len(failures)} backup(s) failed:\n{details}")
+
+
+def backup_database(srcdb : pathlib.Path, backupdb : pathlib.Path, pages : int = -1,
+                    sleep : float = 0.0, wal : bool = False, page_size : int = None,
+                    safe : bool = True, busy_timeout_ms : int = 5000, fast_copy : bool = True,
+                    verify : bool = False):
     """Wrapper function that backups SQLite database even if it's being accessed by other clients 
-    or concurrently by the same connection (so says documentation). Entire source databases
-    copied in single step.
+    or concurrently by the same connection (so says documentation). By default the entire source 
+    database is copied in a single step.
 
     Args:
         srcdb: Path object that represents file path to database file that is to be backed up.
         backupdb: Path object that represents the file path where the backup file resides.
+        pages: Number of pages copied per backup step. Zero or a negative number copies the 
+               entire database in a single step. Small values make for a slow backup.
+        sleep: Number of seconds to sleep between successive attempts to back up remaining 
+               pages when the source is busy or locked. Waiting on locks is mostly left to 
+               the busy timeout, so no sleep by default.
+        wal: Switch the source database to WAL journal mode before backing it up so that 
+             concurrent writers do not force the backup to restart. The change is persistent.
+        page_size: Page size in bytes of the backup file, e.g. 65536 for fewer and larger writes 
+                   on spinning disks or network storage. The backup always inherits the page 
+                   size of the source, so a different size is applied by vacuuming the backup 
+                   afterwards. None keeps the page size of the source. Should the vacuum 
+                   fail, e.g. because another client has the backup open, a RuntimeWarning 
+                   is issued and the backup keeps the source's page size.
+        safe: Keep the backup file's on-disk journal and sync it with synchronous=NORMAL. If 
+              False, syncing and (outside WAL mode) journaling are turned off on the backup 
+              connection for maximum throughput, at the risk of a corrupt backup file should 
+              the machine crash mid-backup.
+        busy_timeout_ms: Milliseconds each connection waits on a lock held by another client 
+                         before giving up with "database is locked".
+        fast_copy: Copy source databases larger than FAST_COPY_THRESHOLD bytes file-to-file 
+                   while holding a shared lock on the source and an exclusive lock on the 
+                   backup, rather than through the backup API. Only used when neither is in 
+                   WAL mode.
+        verify: Compare SHA-256 digests of the source and backup files once the backup is done. 
+                WAL files of either are checkpointed first. Only meaningful when nobody writes 
+                to the source during the backup.
+
+    Raises:
+        sqlite3.DatabaseError: if verify is set and the backup does not match the source, or 
+                               a WAL checkpoint needed to compare them is blocked.
     """
-    # Backup database.
-    if _check_files(srcdb, backupdb):
-        con = sqlite3.connect(srcdb)
-        bck = sqlite3.connect(backupdb)
-        with bck:
-            con.backup(bck)
-        bck.close()
-        con.close()
+    # Connection timeout sets SQLite's busy handler, i.e. PRAGMA busy_timeout.
+    timeout = busy_timeout_ms / 1000
+    # Open source database.
+    try:
+        if wal and str(srcdb) != IN_MEMORY_DB:
+            _enable_wal(srcdb, timeout)
+        con = _connect_readonly(srcdb, timeout)
+    except sqlite3.OperationalError:
+        _check_source(srcdb)
+        raise
+    # Backup database. Connections are closed even if the backup fails, releasing their locks.
+    with closing(con):
+        if con.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            _checkpoint_wal(srcdb)
+        try:
+            copied = fast_copy and _fast_copy(con, srcdb, backupdb, timeout, safe)
+            created = not os.path.exists(backupdb)
+            with closing(sqlite3.connect(backupdb, timeout=timeout)) as bck:
+                if not copied:
+                    _tune_destination(bck, safe)
+                    if created and str(srcdb) != IN_MEMORY_DB:
+                        _preallocate(bck, backupdb, os.path.getsize(srcdb))
+                    with bck:
+                        con.backup(bck, pages=pages, sleep=sleep)
+                if verify and str(srcdb) != IN_MEMORY_DB:
+                    _verify(con, bck, srcdb, backupdb, timeout)
+                if page_size is not None:
+                    _set_page_size(bck, page_size)
+        except sqlite3.OperationalError:
+            _check_backup(backupdb)
+            raise
+
+
+def backup_many(pairs, max_workers : int = os.cpu_count(), **kwargs):
+    """Backs up several SQLite databases concurrently. SQLite releases the GIL while it copies 
+    pages, so independent backups run in parallel on a thread pool.
+
+    Args:
+        pairs: Iterable of (srcdb, backupdb) Path tuples, as passed to backup_database.
+        max_workers: Maximum number of backups run at once. Defaults to the number of CPUs.
+        kwargs: Keyword arguments passed on to every backup_database call.
+
+    Raises:
+        BackupError: once all backups have finished, if any of them failed. Lists every 
+                     failed pair along with its exception.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [((srcdb, backupdb), executor.submit(backup_database, srcdb, backupdb, **kwargs))
+                   for srcdb, backupdb in pairs]
+    failures = [(pair, future.exception()) for pair, future in futures
+                if future.exception() is not None]
+    if failures:
+        raise BackupError(failures)
 
 
 def run(test_params=None):
@@ -86,8 +366,9 @@ def run(test_params=None):
     Raises:
         SystemExit: in case a Python3 version less than 3.7 is being used.
     """
-    if not _version_ok():
-            errstr = f"Unable to backup sqlite3 db. Minimum Python version required: {MIN_VERSION}"
+    if not _VERSION_OK:
+            errstr = "Unable to backup sqlite3 db. Minimum Python version required: "
+            errstr += ".".join(str(n) for n in MIN_VERSION)
             raise SystemExit(errstr)
     
     # test_params for unit-testing purposes.
@@ -97,23 +378,24 @@ def run(test_params=None):
 
 # Main
 if __name__ == "__main__":
+    import logging
     try:
-        logging.basicConfig(filename='backup.log', level=logging.DEBUG,
-                            format='%(asctime)s %(levelname)s: %(message)s',
-                            datefmt='%m/%d/%Y %H:%M:%S %p')
+        # Logging to file is opt-in: SQLITE3BACKUP_LOG=backup.log python3 sqlite3backup.py ...
+        log_file = os.environ.get("SQLITE3BACKUP_LOG")
+        if log_file:
+            logging.basicConfig(filename=log_file, level=logging.DEBUG,
+                                format='%(asctime)s %(levelname)s: %(message)s',
+                                datefmt='%m/%d/%Y %H:%M:%S %p')
+        else:
+            logging.getLogger().addHandler(logging.NullHandler())
         run()
         logging.info("Backup complete. No errors.")
     except (SystemExit, FileNotFoundError, sqlite3.OperationalError) as e: 
         print(f"{type(e).__name__}: {e}")
-        logging.error(f"{type(e).__name__}: {e}")
+        logging.error("%s: %s", type(e).__name__, e)
     # Catches everything but SystemExit, KeyboardInterrupt and GeneratorExit exceptions.
     except Exception as e:
-        logging.error(f"{type(e).__name__}: {e}")
-    
-    
- 
-   
-    
-    
-    
-
+        # Without a log file this would otherwise go unreported.
+        if not log_file:
+            print(f"{type(e).__name__}: {e}")
+        logging.error("%s: %s", type(e).__name__, e)
@@ -2,9 +2,16 @@
 
 import unittest
 import os
+import filecmp
 import stat
 import pathlib
 import sqlite3
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import closing
+from unittest import mock
 
 
 import sqlite3backup as sq3bckup
@@ -34,71 +41,65 @@ class Sql3BackupTests(unittest.TestCase):
         cursor.execute(self.insert_record('Brent Spiner', 'Commander Data'))
         self.conn.commit()
     
-    def drop_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute('DROP TABLE actors_tng')
-        self.conn.commit()
+    def assertBackupMatches(self, dest_db: pathlib.Path = None):
+        # Compare data of the original database with that of its backup.
+        query = 'SELECT * FROM actors_tng'
+        result_original = self.conn.execute(query).fetchall()
+        with closing(sqlite3.connect(dest_db or self.dest_db)) as conn_backup:
+            self.assertEqual(result_original, conn_backup.execute(query).fetchall())
 
     # Setup / Tear Down  -------------------------------------------------------------------------
     def setUp(self):
-        # Create and populate test database.
-        self.conn = sqlite3.connect('test.db')
+        # All test files live in a scratch directory.
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+
+        # Create and populate test database in memory.
+        self.conn = sqlite3.connect(':memory:')
         self.create_table()
         self.populate_table()
-        self.src_db = pathlib.Path('test.db')
 
-        # Dummy backup file to which to copy original data to.
-        with open('test-backup.db', 'w'):
-            pass
-        self.dest_db = pathlib.Path('test-backup.db')
-        self.conn_backup = sqlite3.connect('test-backup.db')
+        # Backup functions take file paths, so keep a small on-disk copy of it as the source.
+        self.src_db = self.tmpdir.joinpath('test.db')
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            self.conn.backup(conn_src)
+
+        # Backup file to which to copy original data to; created on connect.
+        self.dest_db = self.tmpdir.joinpath('test-backup.db')
+        self.conn_backup = sqlite3.connect(self.dest_db)
 
         # Dummy file that is not an sqlite3 db file.
         # Need to write something in file for this to work. 
-        with open('notdbfile.txt', 'w') as f:
+        self.not_db = self.tmpdir.joinpath('notdbfile.txt')
+        with open(self.not_db, 'w') as f:
             f.write("Random text!!")
-        self.not_db = pathlib.Path('notdbfile.txt')
 
         # Dummy directory to write database file; make read-only
-        self.testdir = pathlib.Path('testdir/')
+        self.testdir = self.tmpdir.joinpath('testdir')
         self.testdir.mkdir(mode=0o400)
 
         # Dummy directory path for non-existent directory
-        self.dnedir = pathlib.Path('dnedir/')
+        self.dnedir = self.tmpdir.joinpath('dnedir')
 
     def tearDown(self):
-        # Remove dummy files.
-        if self.not_db.exists():
-            self.not_db.unlink()
-        if self.dest_db.exists():
-            self.dest_db.unlink()
-        if self.testdir.exists():
-            self.testdir.rmdir()
-        
-        # Clear database.
-        self.drop_table()
-
         # Close connections
         self.conn.close()
         self.conn_backup.close()
+
+        # Remove dummy files.
+        shutil.rmtree(self.tmpdir)
     
     # Tests --------------------------------------------------------------------------------------
     def test_backupdb(self):
         # Normal backup - check data by comparing data from two databases.
         sq3bckup.backup_database(self.src_db, self.dest_db)
-        query = 'SELECT * FROM actors_tng'
-        cursor_original = self.conn.cursor()
-        result_original = cursor_original.execute(query)
-        cursor_backup = self.conn_backup.cursor()
-        result_backup = cursor_backup.execute(query)
-        self.assertEqual(result_original.fetchall(), result_backup.fetchall())
+        self.assertBackupMatches()
         
         # Src db does not exist
-        src_dne = pathlib.Path('dne.db')
+        src_dne = self.tmpdir.joinpath('dne.db')
         self.assertRaises(FileNotFoundError, sq3bckup.backup_database, src_dne, self.dest_db)
 
         # Backing up a non-sqlite3 database file
-        self.assertRaises(sqlite3.OperationalError, sq3bckup.backup_database, self.not_db, 
+        self.assertRaises(sqlite3.DatabaseError, sq3bckup.backup_database, self.not_db, 
                           self.dest_db)
         
         # Writing to file for which permission does not exist.
@@ -108,11 +109,197 @@ class Sql3BackupTests(unittest.TestCase):
         
         # Writing to directory for which we do not have access.
         self.assertRaises(PermissionError, sq3bckup.backup_database, self.src_db, 
-                          self.testdir.joinpath(self.dest_db))
+                          self.testdir.joinpath(self.dest_db.name))
         
         # Writing to a path that does not exist.
         self.assertRaises(sqlite3.OperationalError, sq3bckup.backup_database, self.src_db, 
-                          self.dnedir.joinpath(self.dest_db))
+                          self.dnedir.joinpath(self.dest_db.name))
+
+    def lock_backup(self, seconds: float) -> threading.Timer:
+        # Another client holds an exclusive lock on the backup file for a moment.
+        writer = sqlite3.connect(self.dest_db, isolation_level=None, check_same_thread=False)
+        writer.execute('BEGIN EXCLUSIVE')
+        def release():
+            writer.execute('COMMIT')
+            writer.close()
+        timer = threading.Timer(seconds, release)
+        timer.start()
+        return timer
+
+    def test_backupdb_concurrent_writer(self):
+        # Timeout shorter than the lock gives up...
+        timer = self.lock_backup(0.2)
+        try:
+            self.assertRaises(sqlite3.OperationalError, sq3bckup.backup_database, self.src_db, 
+                              self.dest_db, busy_timeout_ms=10)
+        finally:
+            timer.join()
+
+        # ...a longer one waits it out.
+        timer = self.lock_backup(0.2)
+        try:
+            sq3bckup.backup_database(self.src_db, self.dest_db, busy_timeout_ms=5000)
+        finally:
+            timer.join()
+        self.assertBackupMatches()
+
+    @mock.patch.object(sq3bckup, 'FAST_COPY_THRESHOLD', 0)
+    def test_backupdb_fast_copy(self):
+        # Threshold lowered so the small test database takes the file copy path.
+        sq3bckup.backup_database(self.src_db, self.dest_db)
+        # Backup API would have bumped the change counter in the header.
+        self.assertTrue(filecmp.cmp(self.src_db, self.dest_db, shallow=False))
+        self.assertBackupMatches()
+
+        # Client writing to the backup file with an in-memory journal leaves no journal on 
+        # disk; the copy must still wait for its lock rather than overwrite its pages.
+        writer = sqlite3.connect(self.dest_db, isolation_level=None)
+        writer.execute('PRAGMA journal_mode=MEMORY')
+        writer.execute('BEGIN EXCLUSIVE')
+        try:
+            self.assertRaises(sqlite3.OperationalError, sq3bckup.backup_database, 
+                              self.src_db, self.dest_db, busy_timeout_ms=10)
+        finally:
+            writer.execute('COMMIT')
+            writer.close()
+
+    def test_backupdb_preallocate(self):
+        # Fresh backup file is preallocated, then trimmed to the size of the source.
+        dest_db = self.tmpdir.joinpath('test-backup-new.db')
+        with mock.patch.object(sq3bckup, '_preallocate', wraps=sq3bckup._preallocate) as prealloc:
+            sq3bckup.backup_database(self.src_db, dest_db)
+        prealloc.assert_called_once()
+        self.assertEqual(dest_db.stat().st_size, self.src_db.stat().st_size)
+        with closing(sqlite3.connect(dest_db)) as conn_backup:
+            self.assertEqual(conn_backup.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+        self.assertBackupMatches(dest_db)
+
+    def test_backupdb_verify(self):
+        # Backup of a database nobody is writing to matches it past the 100-byte header.
+        sq3bckup.backup_database(self.src_db, self.dest_db, verify=True)
+        self.assertBackupMatches()
+
+        # Byte flipped in the backup file before it is hashed fails the backup.
+        verify = sq3bckup._verify
+        def corrupt_and_verify(*args):
+            with open(self.dest_db, 'r+b') as f:
+                f.seek(-1, os.SEEK_END)
+                last = f.read(1)[0]
+                f.seek(-1, os.SEEK_END)
+                f.write(bytes([last ^ 0xFF]))
+            verify(*args)
+        with mock.patch.object(sq3bckup, '_verify', corrupt_and_verify):
+            self.assertRaises(sqlite3.DatabaseError, sq3bckup.backup_database, self.src_db, 
+                              self.dest_db, verify=True)
+
+    def test_backupdb_verify_wal(self):
+        # Backup of a WAL source is WAL too; a repeat backup lands in its -wal file first.
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            conn_src.execute('PRAGMA journal_mode=WAL')
+            sq3bckup.backup_database(self.src_db, self.dest_db, verify=True)
+            for i in range(500):
+                record = self.insert_record(f'Extra {i}', 'Crewman')
+                conn_src.execute(record)
+                self.conn.execute(record)
+            conn_src.commit()
+            self.conn.commit()
+            sq3bckup.backup_database(self.src_db, self.dest_db, verify=True)
+        self.assertBackupMatches()
+
+    def test_backupdb_wal(self):
+        # Source is switched to WAL mode for good and still backed up in full.
+        sq3bckup.backup_database(self.src_db, self.dest_db, wal=True)
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            self.assertEqual(conn_src.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertBackupMatches()
+
+    def test_backupdb_wal_checkpoint(self):
+        # WAL frames of the source are checkpointed into its main file before the backup.
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            conn_src.execute('PRAGMA journal_mode=WAL')
+            conn_src.execute('PRAGMA wal_autocheckpoint=0')
+            self.conn.execute(self.insert_record('LeVar Burton', 'Lt. Commander Geordi La Forge'))
+            self.conn.commit()
+            conn_src.execute(self.insert_record('LeVar Burton', 'Lt. Commander Geordi La Forge'))
+            conn_src.commit()
+            wal = pathlib.Path(f'{self.src_db}-wal')
+            self.assertGreater(wal.stat().st_size, 0)
+            sq3bckup.backup_database(self.src_db, self.dest_db)
+            self.assertEqual(wal.stat().st_size, 0)
+            self.assertBackupMatches()
+
+            # Reader holding a snapshot of the source blocks the checkpoint; the backup does not 
+            # wait for it.
+            conn_src.execute(self.insert_record('Gates McFadden', 'Dr. Beverly Crusher'))
+            conn_src.commit()
+            self.conn.execute(self.insert_record('Gates McFadden', 'Dr. Beverly Crusher'))
+            self.conn.commit()
+            reader = sqlite3.connect(self.src_db, isolation_level=None)
+            reader.execute('BEGIN')
+            reader.execute('SELECT count(*) FROM actors_tng').fetchone()
+            try:
+                start = time.monotonic()
+                sq3bckup.backup_database(self.src_db, self.dest_db, busy_timeout_ms=5000)
+                self.assertLess(time.monotonic() - start, 1)
+            finally:
+                reader.execute('COMMIT')
+                reader.close()
+            self.assertBackupMatches()
+
+    def test_backupdb_page_size(self):
+        # Backup is vacuumed to the requested page size, for rollback-journal and WAL sources.
+        for journal_mode in ('delete', 'wal'):
+            with closing(sqlite3.connect(self.src_db)) as conn_src:
+                conn_src.execute(f'PRAGMA journal_mode={journal_mode}')
+            dest_db = self.tmpdir.joinpath(f'test-backup-{journal_mode}.db')
+            sq3bckup.backup_database(self.src_db, dest_db, page_size=65536)
+            with closing(sqlite3.connect(dest_db)) as conn_backup:
+                self.assertEqual(conn_backup.execute('PRAGMA page_size').fetchone()[0], 65536)
+                self.assertEqual(conn_backup.execute('PRAGMA journal_mode').fetchone()[0], 
+                                 journal_mode)
+            self.assertBackupMatches(dest_db)
+
+    def test_backupdb_page_size_busy(self):
+        # Another client reading the WAL backup blocks the vacuum; backup itself still succeeds.
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            conn_src.execute('PRAGMA journal_mode=WAL')
+        sq3bckup.backup_database(self.src_db, self.dest_db)
+        self.conn_backup.execute('SELECT count(*) FROM actors_tng').fetchone()
+        with self.assertWarns(RuntimeWarning):
+            sq3bckup.backup_database(self.src_db, self.dest_db, page_size=65536, 
+                                     busy_timeout_ms=100)
+        self.assertBackupMatches()
+        self.assertEqual(self.conn_backup.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_backupdb_wal_repeat(self):
+        # Backup of a WAL source is in WAL mode too; backing up to it again must not need 
+        # exclusive access to leave WAL while another client has it open.
+        with closing(sqlite3.connect(self.src_db)) as conn_src:
+            conn_src.execute('PRAGMA journal_mode=WAL')
+        for safe in (True, False):
+            sq3bckup.backup_database(self.src_db, self.dest_db, safe=safe)
+            self.assertBackupMatches()
+            # conn_backup stays open on the backup as an idle reader.
+            self.conn_backup.execute('SELECT count(*) FROM actors_tng').fetchone()
+            sq3bckup.backup_database(self.src_db, self.dest_db, safe=safe, busy_timeout_ms=100)
+            self.assertBackupMatches()
+
+    def test_backup_many(self):
+        # Same source backed up to two files at once.
+        dest_db2 = self.tmpdir.joinpath('test-backup2.db')
+        sq3bckup.backup_many([(self.src_db, self.dest_db), (self.src_db, dest_db2)])
+        self.assertBackupMatches()
+        self.assertBackupMatches(dest_db2)
+
+        # Every failed pair is reported once all backups are done.
+        src_dne = self.tmpdir.joinpath('dne.db')
+        pairs = [(src_dne, self.dest_db), (self.src_db, self.dest_db), (self.not_db, dest_db2)]
+        with self.assertRaises(sq3bckup.BackupError) as cm:
+            sq3bckup.backup_many(pairs)
+        failures = cm.exception.failures
+        self.assertEqual([pair for pair, _ in failures], [pairs[0], pairs[2]])
+        self.assertIsInstance(failures[0][1], FileNotFoundError)
+        self.assertIsInstance(failures[1][1], sqlite3.DatabaseError)
 
 
 # Main -------------------------------------------------------------------------------------------